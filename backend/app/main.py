@@ -1,15 +1,30 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from app.routes import auth, preferences, chatbot
+from app.database import init_db_pool, close_db_pool
+from app.services.yelp_service import close_yelp_service
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the database connection pool once for the lifetime of the app
+    await init_db_pool()
+    yield
+    await close_yelp_service()
+    await close_db_pool()
+
 app = FastAPI(
     title="KindaLike API",
     description="Restaurant Recommender System API",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # CORS middleware to allow frontend to communicate with backend
@@ -21,6 +36,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress larger responses (recommendation lists and chat history)
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 # Include routers
 app.include_router(auth.router)
 app.include_router(preferences.router)
@@ -37,4 +55,14 @@ async def health_check():
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 5000))
-    uvicorn.run("app.main:app", host="0.0.0.0", port=port, reload=True)
+    reload = os.getenv("RELOAD", "true").lower() == "true"
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=port,
+        reload=reload,
+        loop="auto",  # picks uvloop when it is installed (not available on Windows)
+        http="httptools",
+        # Reload mode always runs a single worker
+        workers=None if reload else int(os.getenv("WEB_CONCURRENCY", 2))
+    )
@@ -1,36 +1,34 @@
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, HTTPException, status, Depends
 from app.models.schemas import UserCreate, UserLogin, TokenResponse, UserResponse
-from app.database import get_db_connection, close_db_connection
-from app.utils import hash_password, verify_password, create_access_token
+from app.database import get_db_pool
+from app.utils import hash_password_async, verify_password_async, create_access_token
 from datetime import datetime
 
 router = APIRouter(prefix="/api/auth", tags=["Authentication"])
 
 @router.post("/signup", response_model=TokenResponse, status_code=status.HTTP_201_CREATED)
-async def signup(user: UserCreate):
+async def signup(user: UserCreate, pool=Depends(get_db_pool)):
     """Register a new user"""
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # Check if username already exists
-        cursor.execute("SELECT id FROM users WHERE username = %s", (user.username,))
-        if cursor.fetchone():
+        # Hash password (off the event loop)
+        hashed_password = await hash_password_async(user.password)
+
+        # Create user; the UNIQUE constraint on username rejects duplicates atomically.
+        # Runs on the pool directly so no connection is held while hashing
+        new_user = await pool.fetchrow(
+            """
+            INSERT INTO users (username, password_hash) VALUES ($1, $2)
+            ON CONFLICT (username) DO NOTHING
+            RETURNING id, username, created_at
+            """,
+            user.username, hashed_password
+        )
+        if not new_user:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Username already exists"
             )
 
-        # Hash password and create user
-        hashed_password = hash_password(user.password)
-        cursor.execute(
-            "INSERT INTO users (username, password_hash) VALUES (%s, %s) RETURNING id, username, created_at",
-            (user.username, hashed_password)
-        )
-        new_user = cursor.fetchone()
-        conn.commit()
-
         # Create JWT token
         token = create_access_token(new_user['id'], new_user['username'])
 
@@ -49,30 +47,21 @@ async def signup(user: UserCreate):
     except HTTPException:
         raise
     except Exception as e:
-        if conn:
-            conn.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error creating user: {str(e)}"
         )
-    finally:
-        if conn:
-            close_db_connection(conn)
 
 @router.post("/login", response_model=TokenResponse)
-async def login(credentials: UserLogin):
+async def login(credentials: UserLogin, pool=Depends(get_db_pool)):
     """Login user and return JWT token"""
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # Get user by username
-        cursor.execute(
-            "SELECT id, username, password_hash, created_at FROM users WHERE username = %s",
-            (credentials.username,)
+        # Get user by username. Runs on the pool directly so no connection is
+        # held while the password is verified
+        user = await pool.fetchrow(
+            "SELECT id, username, password_hash, created_at FROM users WHERE username = $1",
+            credentials.username
         )
-        user = cursor.fetchone()
 
         if not user:
             raise HTTPException(
@@ -81,7 +70,7 @@ async def login(credentials: UserLogin):
             )
 
         # Verify password
-        if not verify_password(credentials.password, user['password_hash']):
+        if not await verify_password_async(credentials.password, user['password_hash']):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid username or password"
@@ -109,6 +98,3 @@ async def login(credentials: UserLogin):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error during login: {str(e)}"
         )
-    finally:
-        if conn:
-            close_db_connection(conn)
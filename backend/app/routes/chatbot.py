@@ -1,21 +1,46 @@
 """
 Chatbot API endpoints for restaurant recommendations
 """
-from fastapi import APIRouter, Header, Request, HTTPException
+from fastapi import APIRouter, Header, Request, HTTPException, Depends
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from starlette.datastructures import Headers
 from typing import Optional, List
 from pydantic import BaseModel
-import json
+import asyncio
+import os
+import orjson
 from loguru import logger
 
-from ..database import get_db_connection
+from ..database import get_db, get_db_pool
 from ..utils import get_current_user
 from ..services.llm_service import get_llm_service
-from ..services.yelp_service import get_yelp_service
+from ..services.yelp_service import get_yelp_service, Restaurant
 from ..services.location_service import get_location_service
+from ..services.prefs_cache import get_cached_preferences, cache_preferences
 
 
 router = APIRouter(prefix="/api/chat", tags=["chatbot"])
 
+# How long to wait for the LLM before falling back to the speculative
+# preference-based Yelp search
+LLM_SPECULATION_TIMEOUT_SECONDS = float(os.getenv("LLM_SPECULATION_TIMEOUT_SECONDS", 5.0))
+
+# LLM calls that outlived the speculation timeout. They keep running so their
+# results still reach the LLM caches; holding a reference keeps them from being
+# garbage collected before they finish
+_background_tasks: set = set()
+
+
+async def current_user_id(authorization: Optional[str] = Header(None)) -> int:
+    """
+    FastAPI dependency: the authenticated user's id
+
+    Declared before the connection dependency so requests with a bad token
+    are rejected before a pooled connection is checked out.
+    """
+    return get_current_user(authorization)
+
 
 # Request/Response Models
 class ChatMessageRequest(BaseModel):
@@ -30,7 +55,7 @@ class ChatMessageResponse(BaseModel):
     session_id: int
     message_id: int
     response: str
-    recommendations: Optional[List[dict]] = None
+    recommendations: Optional[List[Restaurant]] = None
 
 
 class ChatSessionResponse(BaseModel):
@@ -42,6 +67,105 @@ class ChatSessionResponse(BaseModel):
     message_count: int
 
 
+async def _get_or_create_session(pool, user_id: int, session_id: Optional[int]) -> int:
+    """Return the id of the user's active session, creating a new one if none was given"""
+    async with pool.acquire() as conn:
+        if session_id:
+            # Use existing session
+            session_id = await conn.fetchval(
+                "SELECT id FROM chat_sessions WHERE id = $1 AND user_id = $2 AND is_active = TRUE",
+                session_id, user_id
+            )
+            if not session_id:
+                raise HTTPException(status_code=404, detail="Chat session not found or inactive")
+            return session_id
+
+        # Create new session
+        return await conn.fetchval(
+            "INSERT INTO chat_sessions (user_id) VALUES ($1) RETURNING id",
+            user_id
+        )
+
+
+async def _get_user_preferences(pool, user_id: int) -> dict:
+    """Return the user's saved preferences, or an empty dict"""
+    user_preferences = get_cached_preferences(user_id)
+    if user_preferences is not None:
+        return user_preferences
+
+    async with pool.acquire() as conn:
+        prefs_row = await conn.fetchrow(
+            "SELECT cuisine_type, price_range, dining_style, dietary_restrictions, atmosphere FROM user_preferences WHERE user_id = $1",
+            user_id
+        )
+    user_preferences = dict(prefs_row) if prefs_row else {}
+    cache_preferences(user_id, user_preferences)
+    return user_preferences
+
+
+async def _resolve_location(location: Optional[str], headers: Headers, peer_ip: Optional[str]) -> str:
+    """Return the manual location if given, otherwise detect it from the client IP"""
+    if location:
+        return location
+
+    location_service = get_location_service()
+
+    # Extract IP from request headers
+    client_ip = location_service.extract_ip_from_request(headers, peer_ip)
+
+    # Get location info (blocking HTTP call, keep it off the event loop)
+    location_info = await run_in_threadpool(location_service.get_location_from_ip, client_ip)
+    return location_info.get("formatted_location", "Ithaca, NY")
+
+
+async def _plan_and_search(query: str, user_preferences: dict, location: str, limit: int = 5) -> dict:
+    """
+    Turn the query into search parameters with the LLM, then search Yelp
+
+    If the user has a saved cuisine, a coarse preference-only Yelp search
+    starts alongside the LLM. When the LLM answers within the timeout the
+    speculative search is cancelled and a refined search is run; otherwise
+    the speculative results are used and the LLM call is left to finish in
+    the background, so the next identical query is answered from its cache.
+    """
+    llm_service = get_llm_service()
+    yelp_service = get_yelp_service()
+
+    llm_task = asyncio.create_task(llm_service.generate_categories_async(
+        query=query,
+        user_preferences=user_preferences
+    ))
+
+    speculative_task = None
+    if user_preferences and user_preferences.get("cuisine_type"):
+        speculative_task = asyncio.create_task(yelp_service.search_with_preferences_async(
+            location=location,
+            user_preferences=user_preferences,
+            limit=limit
+        ))
+        await asyncio.wait({llm_task}, timeout=LLM_SPECULATION_TIMEOUT_SECONDS)
+
+        if not llm_task.done():
+            # LLM missed its budget, use the preference-based results
+            logger.info(f"⏱️ LLM did not answer within {LLM_SPECULATION_TIMEOUT_SECONDS}s, using preference-based search")
+            _background_tasks.add(llm_task)
+            llm_task.add_done_callback(_background_tasks.discard)
+            return await speculative_task
+
+        speculative_task.cancel()
+
+    llm_result = await llm_task
+    # Only serialized if the record is actually emitted
+    logger.opt(lazy=True).info("✅ LLM generated categories: {}", lambda: orjson.dumps(llm_result).decode())
+
+    return await yelp_service.search_with_llm_params_async(
+        location=location,
+        llm_categories=llm_result,
+        user_preferences=user_preferences,
+        limit=limit
+    )
+
+
 @router.post("/message", response_model=ChatMessageResponse)
 async def send_chat_message(
     request: Request,
@@ -68,102 +192,38 @@ async def send_chat_message(
     user_id = get_current_user(authorization)
     logger.info(f"✅ User authenticated: user_id={user_id}")
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Connections are taken from the pool per query so none is held
+    # while waiting on the LLM or Yelp
+    pool = await get_db_pool()
 
     try:
-        # Step 1: Get or create chat session
-        logger.info("🔄 Step 1: Getting or creating chat session...")
-        if chat_request.session_id:
-            # Use existing session
-            cursor.execute(
-                "SELECT id FROM chat_sessions WHERE id = %s AND user_id = %s AND is_active = TRUE",
-                (chat_request.session_id, user_id)
-            )
-            session = cursor.fetchone()
-            if not session:
-                raise HTTPException(status_code=404, detail="Chat session not found or inactive")
-            session_id = session['id']
-        else:
-            # Create new session
-            cursor.execute(
-                "INSERT INTO chat_sessions (user_id) VALUES (%s) RETURNING id",
-                (user_id,)
-            )
-            session_id = cursor.fetchone()['id']
-            conn.commit()
-
-        logger.info(f"✅ Using session_id={session_id}")
-
-        # Step 2: Get user preferences
-        logger.info("🔄 Step 2: Fetching user preferences...")
-        cursor.execute(
-            "SELECT cuisine_type, price_range, dining_style, dietary_restrictions, atmosphere FROM user_preferences WHERE user_id = %s",
-            (user_id,)
+        # Steps 1-3 are independent, so run them concurrently
+        # (session and preferences each use their own pooled connection)
+        logger.info("🔄 Steps 1-3: Getting chat session, user preferences and location...")
+        session_id, user_preferences, location = await asyncio.gather(
+            _get_or_create_session(pool, user_id, chat_request.session_id),
+            _get_user_preferences(pool, user_id),
+            _resolve_location(chat_request.location, request.headers, request.client.host if request.client else None)
         )
-        prefs_row = cursor.fetchone()
-        user_preferences = dict(prefs_row) if prefs_row else {}
+        logger.info(f"✅ Using session_id={session_id}")
         logger.info(f"✅ User preferences: {user_preferences}")
-
-        # Step 3: Detect location
-        logger.info("🔄 Step 3: Detecting location...")
-        location = chat_request.location
-        if not location:
-            # Get location from IP
-            location_service = get_location_service()
-
-            # Extract IP from request headers
-            client_ip = location_service.extract_ip_from_request(dict(request.headers))
-
-            # Get location info
-            location_info = location_service.get_location_from_ip(client_ip)
-            location = location_info.get("formatted_location", "Ithaca, NY")
-
         logger.info(f"✅ Using location: {location}")
 
-        # Step 4: Save user message to database
-        logger.info("🔄 Step 4: Saving user message to database...")
-        cursor.execute(
-            "INSERT INTO chat_messages (session_id, role, content) VALUES (%s, %s, %s) RETURNING id",
-            (session_id, "user", chat_request.message)
-        )
-        user_message_id = cursor.fetchone()['id']
-        conn.commit()
-        logger.info(f"✅ User message saved with id={user_message_id}")
-
-        # Step 5: Generate categories with LLM
-        logger.info("🔄 Step 5: Generating categories with LLM...")
-        llm_service = get_llm_service()
-        llm_result = llm_service.generate_categories(
-            query=chat_request.message,
-            user_preferences=user_preferences
-        )
-        logger.info(f"✅ LLM generated categories: {json.dumps(llm_result, indent=2)}")
-
-        # Step 6: Search Yelp for restaurants
-        logger.info("🔄 Step 6: Searching Yelp for restaurants...")
+        # Steps 4-5: Generate categories with LLM and search Yelp
+        logger.info("🔄 Steps 4-5: Generating categories with LLM and searching Yelp...")
         yelp_service = get_yelp_service()
-        yelp_results = yelp_service.search_with_llm_params(
-            location=location,
-            llm_categories=llm_result,
-            user_preferences=user_preferences,
-            limit=5  # Return top 5 recommendations
-        )
+        yelp_results = await _plan_and_search(chat_request.message, user_preferences, location)
         logger.info(f"✅ Yelp returned {len(yelp_results.get('businesses', []))} results")
-        logger.debug(f"Yelp raw results: {json.dumps(yelp_results, indent=2)}")
+        logger.opt(lazy=True).debug("Yelp raw results: {}", lambda: orjson.dumps(yelp_results).decode())
 
-        # Step 7: Format recommendations
-        logger.info("🔄 Step 7: Formatting recommendations...")
-        recommendations = []
-        if "businesses" in yelp_results and yelp_results["businesses"]:
-            for business in yelp_results["businesses"]:
-                formatted = yelp_service.format_restaurant_for_display(business)
-                recommendations.append(formatted)
+        # Step 6: Format recommendations
+        logger.info("🔄 Step 6: Formatting recommendations...")
+        recommendations = yelp_service.format_many(yelp_results.get("businesses") or [])
 
         logger.info(f"✅ Formatted {len(recommendations)} recommendations")
 
-        # Step 8: Generate response message
-        logger.info("🔄 Step 8: Generating response message...")
+        # Step 7: Generate response message
+        logger.info("🔄 Step 7: Generating response message...")
         if recommendations:
             response_text = f"Based on your request for '{chat_request.message}' in {location}, here are my top recommendations:"
         else:
@@ -171,16 +231,17 @@ async def send_chat_message(
 
         logger.info(f"✅ Response: {response_text}")
 
-        # Step 9: Save assistant response to database
-        logger.info("🔄 Step 9: Saving assistant response to database...")
-        cursor.execute(
+        # Step 8: Save user message and assistant response in a single round-trip
+        logger.info("🔄 Step 8: Saving user message and assistant response to database...")
+        rows = await pool.fetch(
             """INSERT INTO chat_messages (session_id, role, content, recommendations)
-               VALUES (%s, %s, %s, %s) RETURNING id""",
-            (session_id, "assistant", response_text, json.dumps(recommendations) if recommendations else None)
+               VALUES ($1, 'user', $2, NULL), ($1, 'assistant', $3, $4)
+               RETURNING id, role""",
+            session_id, chat_request.message, response_text, recommendations or None
         )
-        assistant_message_id = cursor.fetchone()['id']
-        conn.commit()
-        logger.info(f"✅ Assistant response saved with id={assistant_message_id}")
+        message_ids = {row['role']: row['id'] for row in rows}
+        assistant_message_id = message_ids['assistant']
+        logger.info(f"✅ Messages saved: user id={message_ids['user']}, assistant id={assistant_message_id}")
 
         logger.info("🎉 Chat request completed successfully!")
         logger.info("=" * 80)
@@ -192,165 +253,132 @@ async def send_chat_message(
             recommendations=recommendations
         )
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Error processing message: {str(e)}")
         logger.exception(e)
-        conn.rollback()
         raise HTTPException(status_code=500, detail=f"Error processing message: {str(e)}")
-    finally:
-        cursor.close()
-        conn.close()
 
 
 @router.get("/sessions", response_model=List[ChatSessionResponse])
-async def get_chat_sessions(authorization: Optional[str] = Header(None)):
+async def get_chat_sessions(user_id: int = Depends(current_user_id), conn=Depends(get_db)):
     """
     Get all chat sessions for the current user
     """
-    user_id = get_current_user(authorization)
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    try:
-        cursor.execute(
-            """SELECT
-                cs.id,
-                cs.started_at,
-                cs.last_message_at,
-                cs.is_active,
-                COUNT(cm.id) as message_count
-               FROM chat_sessions cs
-               LEFT JOIN chat_messages cm ON cs.id = cm.session_id
-               WHERE cs.user_id = %s
-               GROUP BY cs.id, cs.started_at, cs.last_message_at, cs.is_active
-               ORDER BY cs.last_message_at DESC""",
-            (user_id,)
+    sessions = await conn.fetch(
+        """SELECT id, started_at, last_message_at, is_active, message_count
+           FROM chat_sessions
+           WHERE user_id = $1
+           ORDER BY last_message_at DESC""",
+        user_id
+    )
+
+    return [
+        ChatSessionResponse(
+            id=session['id'],
+            started_at=session['started_at'].isoformat(),
+            last_message_at=session['last_message_at'].isoformat(),
+            is_active=session['is_active'],
+            message_count=session['message_count']
         )
-        sessions = cursor.fetchall()
-
-        return [
-            ChatSessionResponse(
-                id=session['id'],
-                started_at=session['started_at'].isoformat(),
-                last_message_at=session['last_message_at'].isoformat(),
-                is_active=session['is_active'],
-                message_count=session['message_count']
-            )
-            for session in sessions
-        ]
-
-    finally:
-        cursor.close()
-        conn.close()
+        for session in sessions
+    ]
 
 
 @router.post("/sessions/new")
-async def create_new_session(authorization: Optional[str] = Header(None)):
+async def create_new_session(user_id: int = Depends(current_user_id), conn=Depends(get_db)):
     """
     Create a new chat session
     """
-    user_id = get_current_user(authorization)
+    session = await conn.fetchrow(
+        "INSERT INTO chat_sessions (user_id) VALUES ($1) RETURNING id, started_at, last_message_at, is_active",
+        user_id
+    )
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    return ChatSessionResponse(
+        id=session['id'],
+        started_at=session['started_at'].isoformat(),
+        last_message_at=session['last_message_at'].isoformat(),
+        is_active=session['is_active'],
+        message_count=0
+    )
 
-    try:
-        cursor.execute(
-            "INSERT INTO chat_sessions (user_id) VALUES (%s) RETURNING id, started_at, last_message_at, is_active",
-            (user_id,)
-        )
-        session = cursor.fetchone()
-        conn.commit()
 
-        return ChatSessionResponse(
-            id=session['id'],
-            started_at=session['started_at'].isoformat(),
-            last_message_at=session['last_message_at'].isoformat(),
-            is_active=session['is_active'],
-            message_count=0
-        )
+# Rows fetched per round-trip while streaming a session's messages
+MESSAGES_STREAM_PREFETCH = 200
+
+
+async def _stream_session_messages(conn, session_id: int):
+    """
+    Yield a session's messages as a JSON array, row by row, from a server-side cursor
 
-    finally:
-        cursor.close()
-        conn.close()
+    Recommendations are passed through as the JSON text stored in the database
+    instead of being decoded and re-encoded.
+    """
+    # Server-side cursors only live inside a transaction
+    async with conn.transaction():
+        yield b"["
+        separator = b""
+        async for msg in conn.cursor(
+            """SELECT id, role, content, recommendations::text AS recommendations, created_at
+               FROM chat_messages
+               WHERE session_id = $1
+               ORDER BY created_at ASC, id ASC""",
+            session_id,
+            prefetch=MESSAGES_STREAM_PREFETCH
+        ):
+            recommendations = msg['recommendations']
+            yield separator + orjson.dumps({
+                "id": msg['id'],
+                "role": msg['role'],
+                "content": msg['content'],
+                "recommendations": orjson.Fragment(recommendations) if recommendations is not None else None,
+                "created_at": msg['created_at'].isoformat()
+            })
+            separator = b","
+        yield b"]"
 
 
 @router.get("/sessions/{session_id}/messages")
 async def get_session_messages(
     session_id: int,
-    authorization: Optional[str] = Header(None)
+    user_id: int = Depends(current_user_id),
+    conn=Depends(get_db)
 ):
     """
     Get all messages for a specific chat session
-    """
-    user_id = get_current_user(authorization)
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    try:
-        # Verify session belongs to user
-        cursor.execute(
-            "SELECT id FROM chat_sessions WHERE id = %s AND user_id = %s",
-            (session_id, user_id)
-        )
-        session = cursor.fetchone()
-        if not session:
-            raise HTTPException(status_code=404, detail="Chat session not found")
-
-        # Get messages
-        cursor.execute(
-            """SELECT id, role, content, recommendations, created_at
-               FROM chat_messages
-               WHERE session_id = %s
-               ORDER BY created_at ASC""",
-            (session_id,)
-        )
-        messages = cursor.fetchall()
 
-        return [
-            {
-                "id": msg['id'],
-                "role": msg['role'],
-                "content": msg['content'],
-                "recommendations": msg['recommendations'],
-                "created_at": msg['created_at'].isoformat()
-            }
-            for msg in messages
-        ]
+    Sessions can grow without bound, so messages are streamed instead of
+    being loaded into memory all at once.
+    """
+    # Verify session belongs to user
+    session = await conn.fetchrow(
+        "SELECT id FROM chat_sessions WHERE id = $1 AND user_id = $2",
+        session_id, user_id
+    )
+    if not session:
+        raise HTTPException(status_code=404, detail="Chat session not found")
 
-    finally:
-        cursor.close()
-        conn.close()
+    # The dependency keeps the connection checked out until the response has been sent
+    return StreamingResponse(_stream_session_messages(conn, session_id), media_type="application/json")
 
 
 @router.delete("/sessions/{session_id}")
 async def deactivate_session(
     session_id: int,
-    authorization: Optional[str] = Header(None)
+    user_id: int = Depends(current_user_id),
+    conn=Depends(get_db)
 ):
     """
     Deactivate a chat session (soft delete)
     """
-    user_id = get_current_user(authorization)
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    try:
-        cursor.execute(
-            "UPDATE chat_sessions SET is_active = FALSE WHERE id = %s AND user_id = %s RETURNING id",
-            (session_id, user_id)
-        )
-        result = cursor.fetchone()
-        conn.commit()
-
-        if not result:
-            raise HTTPException(status_code=404, detail="Chat session not found")
+    result = await conn.fetchrow(
+        "UPDATE chat_sessions SET is_active = FALSE WHERE id = $1 AND user_id = $2 RETURNING id",
+        session_id, user_id
+    )
 
-        return {"message": "Chat session deactivated successfully"}
+    if not result:
+        raise HTTPException(status_code=404, detail="Chat session not found")
 
-    finally:
-        cursor.close()
-        conn.close()
+    return {"message": "Chat session deactivated successfully"}
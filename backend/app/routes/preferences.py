@@ -1,8 +1,9 @@
-from fastapi import APIRouter, HTTPException, status, Header
+from fastapi import APIRouter, HTTPException, status, Header, Depends
 from typing import Optional
 from app.models.schemas import UserPreferences, UserPreferencesResponse
-from app.database import get_db_connection, close_db_connection
-from app.utils import decode_access_token
+from app.database import get_db
+from app.utils import decode_access_token, get_bearer_token
+from app.services.prefs_cache import invalidate_preferences
 
 router = APIRouter(prefix="/api/preferences", tags=["Preferences"])
 
@@ -15,8 +16,7 @@ def get_current_user(authorization: Optional[str] = Header(None)):
         )
 
     try:
-        # Extract token from "Bearer <token>" format
-        token = authorization.split(" ")[1] if " " in authorization else authorization
+        token = get_bearer_token(authorization)
         payload = decode_access_token(token)
         return payload['user_id']
     except Exception as e:
@@ -28,104 +28,60 @@ def get_current_user(authorization: Optional[str] = Header(None)):
 @router.post("/", response_model=UserPreferencesResponse, status_code=status.HTTP_201_CREATED)
 async def create_or_update_preferences(
     preferences: UserPreferences,
-    authorization: Optional[str] = Header(None)
+    user_id: int = Depends(get_current_user),
+    conn=Depends(get_db)
 ):
     """Create or update user preferences"""
-    user_id = get_current_user(authorization)
-    conn = None
-
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # Check if preferences already exist for this user
-        cursor.execute(
-            "SELECT id FROM user_preferences WHERE user_id = %s",
-            (user_id,)
+        # Insert or update in one atomic statement (user_id is UNIQUE)
+        result = await conn.fetchrow(
+            """
+            INSERT INTO user_preferences
+            (user_id, cuisine_type, price_range, dining_style, dietary_restrictions, atmosphere)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            ON CONFLICT (user_id) DO UPDATE
+            SET cuisine_type = EXCLUDED.cuisine_type,
+                price_range = EXCLUDED.price_range,
+                dining_style = EXCLUDED.dining_style,
+                dietary_restrictions = EXCLUDED.dietary_restrictions,
+                atmosphere = EXCLUDED.atmosphere
+            RETURNING id, user_id, cuisine_type, price_range, dining_style,
+                      dietary_restrictions, atmosphere, created_at, updated_at
+            """,
+            user_id,
+            preferences.cuisine_type,
+            preferences.price_range,
+            preferences.dining_style,
+            preferences.dietary_restrictions,
+            preferences.atmosphere
         )
-        existing = cursor.fetchone()
 
-        if existing:
-            # Update existing preferences
-            cursor.execute(
-                """
-                UPDATE user_preferences
-                SET cuisine_type = %s,
-                    price_range = %s,
-                    dining_style = %s,
-                    dietary_restrictions = %s,
-                    atmosphere = %s
-                WHERE user_id = %s
-                RETURNING id, user_id, cuisine_type, price_range, dining_style,
-                          dietary_restrictions, atmosphere, created_at, updated_at
-                """,
-                (
-                    preferences.cuisine_type,
-                    preferences.price_range,
-                    preferences.dining_style,
-                    preferences.dietary_restrictions,
-                    preferences.atmosphere,
-                    user_id
-                )
-            )
-        else:
-            # Insert new preferences
-            cursor.execute(
-                """
-                INSERT INTO user_preferences
-                (user_id, cuisine_type, price_range, dining_style, dietary_restrictions, atmosphere)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                RETURNING id, user_id, cuisine_type, price_range, dining_style,
-                          dietary_restrictions, atmosphere, created_at, updated_at
-                """,
-                (
-                    user_id,
-                    preferences.cuisine_type,
-                    preferences.price_range,
-                    preferences.dining_style,
-                    preferences.dietary_restrictions,
-                    preferences.atmosphere
-                )
-            )
-
-        result = cursor.fetchone()
-        conn.commit()
+        # The chatbot reads preferences through the cache
+        invalidate_preferences(user_id)
 
-        return UserPreferencesResponse(**result)
+        return UserPreferencesResponse(**dict(result))
 
     except HTTPException:
         raise
     except Exception as e:
-        if conn:
-            conn.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error saving preferences: {str(e)}"
         )
-    finally:
-        if conn:
-            close_db_connection(conn)
 
 @router.get("/", response_model=UserPreferencesResponse)
-async def get_preferences(authorization: Optional[str] = Header(None)):
+async def get_preferences(user_id: int = Depends(get_current_user), conn=Depends(get_db)):
     """Get user preferences"""
-    user_id = get_current_user(authorization)
-    conn = None
-
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute(
+        result = await conn.fetchrow(
             """
             SELECT id, user_id, cuisine_type, price_range, dining_style,
                    dietary_restrictions, atmosphere, created_at, updated_at
             FROM user_preferences
-            WHERE user_id = %s
+            WHERE user_id = $1
             """,
-            (user_id,)
+            user_id
         )
-        result = cursor.fetchone()
 
         if not result:
             raise HTTPException(
@@ -133,7 +89,7 @@ async def get_preferences(authorization: Optional[str] = Header(None)):
                 detail="Preferences not found"
             )
 
-        return UserPreferencesResponse(**result)
+        return UserPreferencesResponse(**dict(result))
 
     except HTTPException:
         raise
@@ -142,6 +98,3 @@ async def get_preferences(authorization: Optional[str] = Header(None)):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error fetching preferences: {str(e)}"
         )
-    finally:
-        if conn:
-            close_db_connection(conn)
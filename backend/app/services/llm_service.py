@@ -3,35 +3,99 @@ LLM Service for Restaurant Category Generation
 Ports the hierarchical category generation logic from the Jupyter notebook
 """
 import os
-import json
-from typing import Dict, Any, Optional
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
+import re
+import asyncio
+import copy
+import orjson
+import threading
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Tuple
+from cachetools import LRUCache
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+from loguru import logger
 
+from .semantic_cache import SemanticCache
+from .yelp_service import PRICE_LEVELS
 
-class LLMService:
-    """Service for generating restaurant categories using LLM"""
 
-    def __init__(self):
-        """Initialize the LLM service with LiteLLM configuration"""
-        self.api_key = os.getenv("LITELLM_API_KEY")
-        self.base_url = os.getenv("LITELLM_BASE_URL", "https://api.ai.it.cornell.edu")
-        self.model = os.getenv("LITELLM_MODEL", "openai.gpt-4o")
+# JSON object inside a ```json (or bare ```) markdown code block
+_CODEBLOCK_RE = re.compile(r"```(?:json)?\s*(\{.*?\})\s*```", re.S)
 
-        if not self.api_key:
-            raise ValueError("LITELLM_API_KEY environment variable is not set")
+# Cuisine keywords -> (display name, Yelp category alias). Queries that are just
+# one of these ("sushi", "thai food near me") are answered without the LLM
+_SIMPLE_CUISINES = {
+    "italian": ("Italian", "italian"),
+    "pizza": ("Pizza", "pizza"),
+    "sushi": ("Sushi", "sushi"),
+    "japanese": ("Japanese", "japanese"),
+    "ramen": ("Ramen", "ramen"),
+    "chinese": ("Chinese", "chinese"),
+    "dim sum": ("Dim Sum", "dimsum"),
+    "hot pot": ("Hot Pot", "hotpot"),
+    "thai": ("Thai", "thai"),
+    "vietnamese": ("Vietnamese", "vietnamese"),
+    "pho": ("Vietnamese", "vietnamese"),
+    "korean": ("Korean", "korean"),
+    "indian": ("Indian", "indpak"),
+    "mexican": ("Mexican", "mexican"),
+    "tacos": ("Tacos", "tacos"),
+    "french": ("French", "french"),
+    "greek": ("Greek", "greek"),
+    "mediterranean": ("Mediterranean", "mediterranean"),
+    "middle eastern": ("Middle Eastern", "mideastern"),
+    "turkish": ("Turkish", "turkish"),
+    "ethiopian": ("Ethiopian", "ethiopian"),
+    "spanish": ("Spanish", "spanish"),
+    "tapas": ("Tapas", "tapas"),
+    "caribbean": ("Caribbean", "caribbean"),
+    "american": ("American", "tradamerican"),
+    "burgers": ("Burgers", "burgers"),
+    "burger": ("Burgers", "burgers"),
+    "bbq": ("Barbeque", "bbq"),
+    "barbecue": ("Barbeque", "bbq"),
+    "steak": ("Steakhouses", "steak"),
+    "steakhouse": ("Steakhouses", "steak"),
+    "seafood": ("Seafood", "seafood"),
+    "wings": ("Chicken Wings", "chicken_wings"),
+    "sandwiches": ("Sandwiches", "sandwiches"),
+    "salad": ("Salad", "salad"),
+    "vegan": ("Vegan", "vegan"),
+    "vegetarian": ("Vegetarian", "vegetarian"),
+    "halal": ("Halal", "halal"),
+    "breakfast": ("Breakfast & Brunch", "breakfast_brunch"),
+    "brunch": ("Breakfast & Brunch", "breakfast_brunch"),
+    "coffee": ("Coffee & Tea", "coffee"),
+    "bakery": ("Bakeries", "bakeries"),
+    "dessert": ("Desserts", "desserts"),
+    "desserts": ("Desserts", "desserts"),
+    "ice cream": ("Ice Cream & Frozen Yogurt", "icecream"),
+    "bubble tea": ("Bubble Tea", "bubbletea")
+}
+_SIMPLE_CUISINE_RE = re.compile(
+    r"(?:(?:some|good|best) )*("
+    + "|".join(re.escape(keyword) for keyword in sorted(_SIMPLE_CUISINES, key=len, reverse=True))
+    + r")(?: food| restaurants?| places?| spots?)?(?: near me| nearby| around here)?[.!?]?"
+)
 
-        # Initialize ChatOpenAI with LiteLLM configuration
-        self.llm = ChatOpenAI(
-            model=self.model,
-            api_key=self.api_key,
-            base_url=self.base_url,
-            temperature=0.7,
-            max_tokens=500
-        )
+# Saved dietary_restrictions values that mean "no restrictions"
+_NO_DIETARY_RESTRICTIONS = {None, "", "None", "Not specified"}
+
+# Parsed LLM results kept per (normalized query, preferences)
+LLM_CACHE_SIZE = 1024
+
+# LLM calls allowed in flight at once for generate_categories_batch
+LLM_BATCH_MAX_CONCURRENCY = 10
+
+# Paraphrased queries reuse a cached result when their embeddings are this similar
+LLM_SEMANTIC_CACHE_SIZE = 2048
+LLM_SEMANTIC_CACHE_THRESHOLD = float(os.getenv("LLM_SEMANTIC_CACHE_THRESHOLD", 0.92))
 
-        # System prompt for category generation
-        self.system_prompt = """You are a restaurant recommendation expert.
+
+# System prompt for category generation. It is identical on every call and sent
+# first, so providers with prompt caching can reuse it; everything that varies
+# per request goes in the human message after it.
+SYSTEM_PROMPT = """You are a restaurant recommendation expert.
 Your task is to analyze user queries and generate structured search parameters for finding restaurants.
 
 When a user asks for restaurant recommendations, break down their request into:
@@ -46,23 +110,22 @@ Be flexible and creative in interpretation. Consider implicit meanings:
 - "healthy" → fresh, organic, vegetarian/vegan options
 
 Return a JSON object with this exact structure:
-{{
+{
     "hierarchical_categories": ["General Category", "Specific Category", "Very Specific"],
     "primary_categories": ["yelp_category1", "yelp_category2"],
-    "attributes": {{
+    "attributes": {
         "cuisine_type": "string or null",
         "price_level": "1-4 or null",
         "occasion": "string or null",
         "ambiance_keywords": ["keyword1", "keyword2"],
         "special_features": ["feature1", "feature2"]
-    }},
+    },
     "reasoning": "Brief explanation of your interpretation"
-}}"""
+}"""
+
 
-        # Create the prompt template
-        self.prompt_template = ChatPromptTemplate.from_messages([
-            ("system", self.system_prompt),
-            ("human", """Analyze this restaurant request and generate search parameters:
+# Per-request part of the prompt, filled with str.format
+HUMAN_TEMPLATE = """Analyze this restaurant request and generate search parameters:
 
 User Query: {query}
 
@@ -73,11 +136,258 @@ User Preferences (if available):
 - Dietary Restrictions: {dietary_restrictions}
 - Atmosphere: {atmosphere}
 
-Generate the JSON response following the specified structure.""")
-        ])
+Generate the JSON response following the specified structure."""
+
+# Structured output schema matching SYSTEM_PROMPT. With strict mode the model
+# can only return JSON of this shape, so no markdown has to be stripped
+CATEGORIES_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "restaurant_categories",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "hierarchical_categories": {"type": "array", "items": {"type": "string"}},
+                "primary_categories": {"type": "array", "items": {"type": "string"}},
+                "attributes": {
+                    "type": "object",
+                    "properties": {
+                        "cuisine_type": {"type": ["string", "null"]},
+                        "price_level": {"type": ["integer", "null"]},
+                        "occasion": {"type": ["string", "null"]},
+                        "ambiance_keywords": {"type": "array", "items": {"type": "string"}},
+                        "special_features": {"type": "array", "items": {"type": "string"}}
+                    },
+                    "required": ["cuisine_type", "price_level", "occasion", "ambiance_keywords", "special_features"],
+                    "additionalProperties": False
+                },
+                "reasoning": {"type": "string"}
+            },
+            "required": ["hierarchical_categories", "primary_categories", "attributes", "reasoning"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Set to "false" for models behind LiteLLM that do not support json_schema output
+LLM_STRUCTURED_OUTPUT = os.getenv("LLM_STRUCTURED_OUTPUT", "true").lower() == "true"
+
+
+def _build_system_message(model: str) -> SystemMessage:
+    """
+    Build the system message once per service
+
+    OpenAI models cache long prompt prefixes automatically. Anthropic models
+    (routed through LiteLLM) only cache blocks marked with cache_control.
+    """
+    model_name = model.lower()
+    if "claude" in model_name or "anthropic" in model_name:
+        return SystemMessage(content=[{
+            "type": "text",
+            "text": SYSTEM_PROMPT,
+            "cache_control": {"type": "ephemeral"}
+        }])
+    return SystemMessage(content=SYSTEM_PROMPT)
+
+
+class LLMService:
+    """Service for generating restaurant categories using LLM"""
+
+    def __init__(self):
+        """Initialize the LLM service with LiteLLM configuration"""
+        self.api_key = os.getenv("LITELLM_API_KEY")
+        self.base_url = os.getenv("LITELLM_BASE_URL", "https://api.ai.it.cornell.edu")
+        self.model = os.getenv("LITELLM_MODEL", "openai.gpt-4o")
+
+        if not self.api_key:
+            raise ValueError("LITELLM_API_KEY environment variable is not set")
+
+        # Initialize ChatOpenAI with LiteLLM configuration
+        self.llm = ChatOpenAI(
+            model=self.model,
+            api_key=self.api_key,
+            base_url=self.base_url,
+            temperature=0.7,
+            max_tokens=500
+        )
+
+        if LLM_STRUCTURED_OUTPUT:
+            self.llm = self.llm.bind(response_format=CATEGORIES_RESPONSE_FORMAT)
+
+        # The system message is built once and reused as-is, so the cached
+        # prefix stays byte-identical across calls; only the human message is
+        # formatted per request
+        self.system_prompt = SYSTEM_PROMPT
+        self.system_message = _build_system_message(self.model)
+
+        self._categories_cache = LRUCache(maxsize=LLM_CACHE_SIZE)
+        self._categories_cache_lock = threading.Lock()
+        self._cache_hits = 0
+        self._cache_misses = 0
+
+        # Optional semantic cache, enabled by configuring an embedding model
+        self.embedding_model = os.getenv("LITELLM_EMBEDDING_MODEL")
+        self.embeddings = None
+        self._semantic_cache = None
+        if self.embedding_model:
+            self.embeddings = OpenAIEmbeddings(
+                model=self.embedding_model,
+                api_key=self.api_key,
+                base_url=self.base_url,
+                # Send raw text; the LiteLLM model name is not a tiktoken model
+                check_embedding_ctx_length=False
+            )
+            self._semantic_cache = SemanticCache(
+                maxsize=LLM_SEMANTIC_CACHE_SIZE,
+                threshold=LLM_SEMANTIC_CACHE_THRESHOLD
+            )
+
+    def cache_info(self) -> Dict[str, int]:
+        """Hit/miss counters and size of the category cache"""
+        with self._categories_cache_lock:
+            return {
+                "hits": self._cache_hits,
+                "misses": self._cache_misses,
+                "maxsize": self._categories_cache.maxsize,
+                "currsize": self._categories_cache.currsize
+            }
+
+    def _cache_key(self, query: str, prefs: Dict[str, Any]) -> tuple:
+        """Normalized query plus the preference fields sent to the LLM"""
+        return (
+            re.sub(r"\s+", " ", query.strip().lower()),
+            prefs.get("cuisine_type", "Not specified"),
+            prefs.get("price_range", "Not specified"),
+            prefs.get("dining_style", "Not specified"),
+            prefs.get("dietary_restrictions", "Not specified"),
+            prefs.get("atmosphere", "Not specified")
+        )
+
+    @staticmethod
+    def _simple_query_categories(normalized_query: str, prefs: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Build the result directly for a query that is only a cuisine name, or return None"""
+        match = _SIMPLE_CUISINE_RE.fullmatch(normalized_query)
+        if not match:
+            return None
+
+        # Dietary restrictions change which places fit ("burgers" for a
+        # vegetarian), so leave those queries to the LLM
+        if prefs.get("dietary_restrictions") not in _NO_DIETARY_RESTRICTIONS:
+            return None
+
+        cuisine, category = _SIMPLE_CUISINES[match.group(1)]
+        atmosphere = prefs.get("atmosphere")
+        return {
+            "hierarchical_categories": ["Food & Dining", "Restaurants", cuisine],
+            "primary_categories": [category],
+            "attributes": {
+                "cuisine_type": cuisine,
+                "price_level": PRICE_LEVELS.get(prefs.get("price_range")),
+                "occasion": None,
+                "ambiance_keywords": [atmosphere] if atmosphere and atmosphere != "Not specified" else [],
+                "special_features": []
+            },
+            "reasoning": f"Simple cuisine query matched directly: {cuisine}"
+        }
+
+    def _lookup(self, cache_key: tuple, prefs: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Answer without the LLM (plain cuisine query or exact repeat), or return None"""
+        # Plain cuisine queries don't need the LLM
+        direct = self._simple_query_categories(cache_key[0], prefs)
+        if direct is not None:
+            return direct
+
+        # Repeated queries (retries, the same search typed again) skip the LLM
+        return self._get_cached(cache_key)
+
+    def _get_cached(self, cache_key: tuple) -> Optional[Dict[str, Any]]:
+        """Return a copy of the cached result for an exact key, or None"""
+        with self._categories_cache_lock:
+            cached = self._categories_cache.get(cache_key)
+            if cached is not None:
+                self._cache_hits += 1
+            else:
+                self._cache_misses += 1
+        return copy.deepcopy(cached) if cached is not None else None
+
+    def _get_semantic_cached(self, query_embedding, cache_key: tuple) -> Optional[Dict[str, Any]]:
+        """Return a copy of the result stored for a similar query with the same preferences, or None"""
+        if query_embedding is None:
+            return None
+        cached = self._semantic_cache.get(query_embedding, cache_key[1:])
+        if cached is None:
+            return None
+        logger.debug("Semantic cache hit for query: {}", cache_key[0])
+        return copy.deepcopy(cached)
 
-        # Create the chain
-        self.chain = self.prompt_template | self.llm
+    def _store(self, cache_key: tuple, query_embedding, result: Dict[str, Any]) -> None:
+        """Cache a successful LLM result (the fallback is never cached)"""
+        with self._categories_cache_lock:
+            self._categories_cache[cache_key] = copy.deepcopy(result)
+        if query_embedding is not None:
+            self._semantic_cache.add(query_embedding, cache_key[1:], copy.deepcopy(result))
+
+    def _build_messages(self, query: str, cache_key: tuple) -> List[BaseMessage]:
+        """Prompt messages for a request: the shared system message plus the formatted query"""
+        _, cuisine_type, price_range, dining_style, dietary_restrictions, atmosphere = cache_key
+        return [
+            self.system_message,
+            HumanMessage(content=HUMAN_TEMPLATE.format(
+                query=query,
+                cuisine_type=cuisine_type,
+                price_range=price_range,
+                dining_style=dining_style,
+                dietary_restrictions=dietary_restrictions,
+                atmosphere=atmosphere
+            ))
+        ]
+
+    def _parse_response(self, response) -> Dict[str, Any]:
+        """Parse and validate the LLM's JSON answer (raises on bad output)"""
+        # Prompt cache hits show up as cached input tokens
+        usage = response.usage_metadata or {}
+        logger.debug(
+            "LLM usage: {} input tokens ({} cached), {} output tokens",
+            usage.get("input_tokens"),
+            usage.get("input_token_details", {}).get("cache_read", 0),
+            usage.get("output_tokens")
+        )
+
+        # Extract content from the response
+        content = response.content
+
+        # Structured output is plain JSON. Without it the LLM might wrap JSON in
+        # a markdown code block, so fall back to extracting it from there
+        try:
+            result = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            match = _CODEBLOCK_RE.search(content)
+            if not match:
+                logger.warning("LLM response is not JSON: {}", content)
+                raise
+            result = orjson.loads(match.group(1))
+
+        # Validate the structure
+        required_keys = ["hierarchical_categories", "primary_categories", "attributes"]
+        if not all(key in result for key in required_keys):
+            raise ValueError(f"LLM response missing required keys. Got: {result.keys()}")
+
+        return result
+
+    def _handle_response(self, cache_key: tuple, query_embedding, response) -> Dict[str, Any]:
+        """Parse the LLM's answer and cache it"""
+        result = self._parse_response(response)
+        self._store(cache_key, query_embedding, result)
+        return result
+
+    def _handle_error(self, query: str, prefs: Dict[str, Any], error: Exception) -> Dict[str, Any]:
+        """Log a failed LLM call and return the fallback categories"""
+        if isinstance(error, orjson.JSONDecodeError):
+            logger.error("Failed to parse LLM response as JSON: {}", error)
+        else:
+            logger.error("Error generating categories: {}", error)
+        return self._get_fallback_categories(query, prefs)
 
     def generate_categories(
         self,
@@ -101,61 +411,77 @@ Generate the JSON response following the specified structure.""")
         Returns:
             Dict containing hierarchical categories and search parameters
         """
-        # Prepare user preferences with defaults
         prefs = user_preferences or {}
-        cuisine_type = prefs.get("cuisine_type", "Not specified")
-        price_range = prefs.get("price_range", "Not specified")
-        dining_style = prefs.get("dining_style", "Not specified")
-        dietary_restrictions = prefs.get("dietary_restrictions", "Not specified")
-        atmosphere = prefs.get("atmosphere", "Not specified")
+
+        cache_key = self._cache_key(query, prefs)
+        cached = self._lookup(cache_key, prefs)
+        if cached is not None:
+            return cached
+
+        # Near-duplicate queries with the same preferences share a result
+        query_embedding = None
+        if self._semantic_cache is not None:
+            try:
+                query_embedding = self.embeddings.embed_query(cache_key[0])
+            except Exception as e:
+                logger.warning("Query embedding failed: {}", e)
+            cached = self._get_semantic_cached(query_embedding, cache_key)
+            if cached is not None:
+                return cached
 
         try:
-            # Invoke the LLM chain
-            response = self.chain.invoke({
-                "query": query,
-                "cuisine_type": cuisine_type,
-                "price_range": price_range,
-                "dining_style": dining_style,
-                "dietary_restrictions": dietary_restrictions,
-                "atmosphere": atmosphere
-            })
-
-            # Extract content from the response
-            content = response.content
-
-            # Parse JSON from the response
-            # The LLM might wrap JSON in markdown code blocks
-            if "```json" in content:
-                # Extract JSON from code block
-                json_start = content.find("```json") + 7
-                json_end = content.find("```", json_start)
-                json_str = content[json_start:json_end].strip()
-            elif "```" in content:
-                # Generic code block
-                json_start = content.find("```") + 3
-                json_end = content.find("```", json_start)
-                json_str = content[json_start:json_end].strip()
-            else:
-                # Assume the entire content is JSON
-                json_str = content.strip()
+            response = self.llm.invoke(self._build_messages(query, cache_key))
+            return self._handle_response(cache_key, query_embedding, response)
+        except Exception as e:
+            return self._handle_error(query, prefs, e)
 
-            result = json.loads(json_str)
+    async def generate_categories_async(
+        self,
+        query: str,
+        user_preferences: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """Async version of generate_categories (same caching and fallback)"""
+        prefs = user_preferences or {}
 
-            # Validate the structure
-            required_keys = ["hierarchical_categories", "primary_categories", "attributes"]
-            if not all(key in result for key in required_keys):
-                raise ValueError(f"LLM response missing required keys. Got: {result.keys()}")
+        cache_key = self._cache_key(query, prefs)
+        cached = self._lookup(cache_key, prefs)
+        if cached is not None:
+            return cached
 
-            return result
+        query_embedding = None
+        if self._semantic_cache is not None:
+            try:
+                query_embedding = await self.embeddings.aembed_query(cache_key[0])
+            except Exception as e:
+                logger.warning("Query embedding failed: {}", e)
+            cached = self._get_semantic_cached(query_embedding, cache_key)
+            if cached is not None:
+                return cached
 
-        except json.JSONDecodeError as e:
-            # Fallback if JSON parsing fails
-            print(f"Failed to parse LLM response as JSON: {e}")
-            print(f"Raw response: {content}")
-            return self._get_fallback_categories(query, prefs)
+        try:
+            response = await self.llm.ainvoke(self._build_messages(query, cache_key))
+            return self._handle_response(cache_key, query_embedding, response)
         except Exception as e:
-            print(f"Error generating categories: {e}")
-            return self._get_fallback_categories(query, prefs)
+            return self._handle_error(query, prefs, e)
+
+    async def generate_categories_batch(
+        self,
+        requests: List[Tuple[str, Optional[Dict[str, Any]]]],
+        max_concurrency: int = LLM_BATCH_MAX_CONCURRENCY
+    ) -> List[Dict[str, Any]]:
+        """
+        Generate categories for several (query, user_preferences) pairs concurrently
+
+        At most max_concurrency LLM calls are in flight at once to stay under
+        the provider's rate limits. Results are returned in request order.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def generate(query: str, user_preferences: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.generate_categories_async(query, user_preferences)
+
+        return await asyncio.gather(*(generate(query, prefs) for query, prefs in requests))
 
     def _get_fallback_categories(
         self,
@@ -169,14 +495,6 @@ Generate the JSON response following the specified structure.""")
         cuisine = preferences.get("cuisine_type", "restaurants")
         price = preferences.get("price_range", "$$")
 
-        # Simple price mapping
-        price_map = {
-            "$": 1,
-            "$$": 2,
-            "$$$": 3,
-            "$$$$": 4
-        }
-
         return {
             "hierarchical_categories": [
                 "Food & Dining",
@@ -186,7 +504,7 @@ Generate the JSON response following the specified structure.""")
             "primary_categories": ["restaurants"],
             "attributes": {
                 "cuisine_type": cuisine if cuisine != "Not specified" else None,
-                "price_level": price_map.get(price, 2),
+                "price_level": PRICE_LEVELS.get(price, 2),
                 "occasion": "casual",
                 "ambiance_keywords": [],
                 "special_features": []
@@ -195,13 +513,7 @@ Generate the JSON response following the specified structure.""")
         }
 
 
-# Singleton instance
-_llm_service_instance = None
-
-
+@lru_cache(maxsize=1)
 def get_llm_service() -> LLMService:
     """Get or create the LLM service singleton"""
-    global _llm_service_instance
-    if _llm_service_instance is None:
-        _llm_service_instance = LLMService()
-    return _llm_service_instance
+    return LLMService()
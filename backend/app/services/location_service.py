@@ -2,8 +2,66 @@
 Location Service for IP Geolocation
 Detects user's location from their IP address
 """
+import os
+import ipaddress
+import threading
 import requests
-from typing import Optional, Dict, Any
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from functools import lru_cache
+from typing import Optional, Dict, Any, Mapping, Union
+from cachetools import TTLCache
+from loguru import logger
+
+
+# IP -> location mappings change rarely, so lookups are cached for a day
+IP_LOCATION_CACHE_TTL_SECONDS = 24 * 60 * 60
+# Failed lookups are remembered briefly so a bad IP or an ip-api.com outage
+# does not cost a request (and rate-limit budget) on every chat message
+IP_LOCATION_FAILURE_TTL_SECONDS = 5 * 60
+
+# Peers whose forwarded-IP headers are trusted (comma-separated addresses or
+# networks). The default covers a reverse proxy on the same host or Docker network
+TRUSTED_PROXIES = tuple(
+    ipaddress.ip_network(network.strip(), strict=False)
+    for network in os.getenv(
+        "TRUSTED_PROXIES",
+        "127.0.0.0/8,::1/128,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16,fc00::/7"
+    ).split(",")
+    if network.strip()
+)
+
+# Headers that may carry the real client IP, in order of preference
+# (lower-case, as ASGI delivers them)
+_IP_HEADERS = (
+    "x-forwarded-for",
+    "x-real-ip",
+    "cf-connecting-ip",  # Cloudflare
+    "true-client-ip",    # Akamai
+    "x-client-ip"
+)
+
+
+IPAddress = Union[ipaddress.IPv4Address, ipaddress.IPv6Address]
+
+
+def _parse_ip(value: str) -> Optional[IPAddress]:
+    """Parse an IP address, or return None if the value is not one"""
+    try:
+        return ipaddress.ip_address(value.strip())
+    except ValueError:
+        return None
+
+
+def _is_trusted_proxy(address: IPAddress) -> bool:
+    """Whether the address belongs to a trusted reverse proxy"""
+    return any(address in network for network in TRUSTED_PROXIES)
+
+
+def _public_ip(value: Optional[str]) -> Optional[str]:
+    """Return the value as a normalized public IP address, or None"""
+    address = _parse_ip(value) if value else None
+    return str(address) if address is not None and address.is_global else None
 
 
 class LocationService:
@@ -14,6 +72,26 @@ class LocationService:
         # Using ip-api.com (free, no API key required for up to 45 requests/minute)
         self.base_url = "http://ip-api.com/json"
 
+        # Reuse connections to ip-api.com across lookups
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=20,
+            max_retries=Retry(
+                total=2,
+                backoff_factor=0.2,
+                status_forcelist=[500, 502, 503, 504],
+                raise_on_status=False
+            )
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # Lookups keyed by IP address (None = the server's own IP)
+        self._cache = TTLCache(maxsize=10000, ttl=IP_LOCATION_CACHE_TTL_SECONDS)
+        self._failure_cache = TTLCache(maxsize=10000, ttl=IP_LOCATION_FAILURE_TTL_SECONDS)
+        self._cache_lock = threading.Lock()
+
     def get_location_from_ip(self, ip_address: Optional[str] = None) -> Dict[str, Any]:
         """
         Get location information from IP address
@@ -34,6 +112,17 @@ class LocationService:
                 "formatted_location": "Ithaca, NY"
             }
         """
+        # Only public addresses are looked up (and cached); anything else is
+        # treated like an unknown client IP
+        ip_address = _public_ip(ip_address)
+
+        with self._cache_lock:
+            cached = self._cache.get(ip_address)
+            if cached is None:
+                cached = self._failure_cache.get(ip_address)
+        if cached is not None:
+            return dict(cached)
+
         # Build URL
         url = f"{self.base_url}/{ip_address}" if ip_address else self.base_url
 
@@ -43,21 +132,24 @@ class LocationService:
         }
 
         try:
-            response = requests.get(url, params=params, timeout=5)
+            response = self.session.get(url, params=params, timeout=5)
             response.raise_for_status()
             data = response.json()
 
             # Check if request was successful
             if data.get("status") != "success":
-                return {
+                fallback = {
                     "error": data.get("message", "Failed to get location"),
                     "city": "Ithaca",  # Default fallback
                     "region": "NY",
                     "formatted_location": "Ithaca, NY"
                 }
+                with self._cache_lock:
+                    self._failure_cache[ip_address] = fallback
+                return dict(fallback)
 
             # Format the response
-            return {
+            location = {
                 "city": data.get("city", ""),
                 "region": data.get("regionName", ""),
                 "region_code": data.get("region", ""),
@@ -70,46 +162,63 @@ class LocationService:
                 "formatted_location": f"{data.get('city', '')}, {data.get('region', '')}"
             }
 
+            with self._cache_lock:
+                self._cache[ip_address] = location
+            return dict(location)
+
         except requests.exceptions.RequestException as e:
-            print(f"Error getting location from IP: {e}")
+            logger.error(f"❌ Error getting location from IP: {e}")
             # Return default location as fallback
-            return {
+            fallback = {
                 "error": str(e),
                 "city": "Ithaca",
                 "region": "NY",
                 "formatted_location": "Ithaca, NY"
             }
-
-    def extract_ip_from_request(self, request_headers: Dict[str, str]) -> Optional[str]:
+            with self._cache_lock:
+                self._failure_cache[ip_address] = fallback
+            return dict(fallback)
+
+    def extract_ip_from_request(
+        self,
+        request_headers: Mapping[str, str],
+        peer_ip: Optional[str] = None
+    ) -> Optional[str]:
         """
         Extract the real client IP from request headers
         Handles proxies and load balancers
 
+        Forwarded-IP headers are only read when the request comes from a
+        trusted proxy (see TRUSTED_PROXIES) or the peer is unknown (e.g. a
+        Unix socket); otherwise the peer address is the client. Proxies append to X-Forwarded-For, so the list is read from the
+        right and the first address that is not a trusted proxy is the client.
+
         Args:
-            request_headers: Dict of HTTP headers from the request
+            request_headers: HTTP headers from the request (e.g. Starlette's
+                request.headers, or a dict with lower-case header names)
+            peer_ip: Address of the directly connected peer (request.client.host)
 
         Returns:
-            IP address string or None
+            Public IP address string or None
         """
-        # Check common headers for the real IP
-        ip_headers = [
-            "X-Forwarded-For",
-            "X-Real-IP",
-            "CF-Connecting-IP",  # Cloudflare
-            "True-Client-IP",    # Akamai
-            "X-Client-IP"
-        ]
-
-        for header in ip_headers:
-            ip = request_headers.get(header)
-            if ip:
-                # X-Forwarded-For can contain multiple IPs (client, proxy1, proxy2)
-                # We want the first one (the client)
-                if "," in ip:
-                    ip = ip.split(",")[0].strip()
-                return ip
+        if peer_ip:
+            peer = _parse_ip(peer_ip)
+            if peer is None or not _is_trusted_proxy(peer):
+                return _public_ip(peer_ip)
 
-        return None
+        # Check common headers for the real IP
+        for header in _IP_HEADERS:
+            value = request_headers.get(header)
+            if not value:
+                continue
+            for entry in reversed(value.split(",")):
+                address = _parse_ip(entry)
+                if address is None:
+                    return None
+                if not _is_trusted_proxy(address):
+                    return str(address) if address.is_global else None
+
+        return _public_ip(peer_ip)
 
     def get_coordinates(self, location: str) -> Optional[Dict[str, float]]:
         """
@@ -130,13 +239,7 @@ class LocationService:
         return None
 
 
-# Singleton instance
-_location_service_instance = None
-
-
+@lru_cache(maxsize=1)
 def get_location_service() -> LocationService:
     """Get or create the location service singleton"""
-    global _location_service_instance
-    if _location_service_instance is None:
-        _location_service_instance = LocationService()
-    return _location_service_instance
+    return LocationService()
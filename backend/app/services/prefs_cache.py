@@ -0,0 +1,37 @@
+"""
+User Preferences Cache
+Keeps recently read user preferences in process to skip a database query per chat message
+"""
+import threading
+from typing import Dict, Any, Optional
+from cachetools import TTLCache
+
+
+# The cache is per worker process and invalidation only reaches the worker
+# that handled the update, so other workers may serve old preferences until
+# the entry expires. Keep this short: it only needs to cover a burst of chat
+# messages, not a whole session
+PREFERENCES_CACHE_TTL_SECONDS = 5
+
+# user_id -> preferences dict (an empty dict means "no preferences saved")
+_preferences_cache = TTLCache(maxsize=10000, ttl=PREFERENCES_CACHE_TTL_SECONDS)
+_preferences_cache_lock = threading.Lock()
+
+
+def get_cached_preferences(user_id: int) -> Optional[Dict[str, Any]]:
+    """Return a copy of the cached preferences for a user, or None on a miss"""
+    with _preferences_cache_lock:
+        preferences = _preferences_cache.get(user_id)
+    return dict(preferences) if preferences is not None else None
+
+
+def cache_preferences(user_id: int, preferences: Dict[str, Any]) -> None:
+    """Store a user's preferences in the cache"""
+    with _preferences_cache_lock:
+        _preferences_cache[user_id] = dict(preferences)
+
+
+def invalidate_preferences(user_id: int) -> None:
+    """Drop a user's cached preferences (call after they are changed)"""
+    with _preferences_cache_lock:
+        _preferences_cache.pop(user_id, None)
@@ -0,0 +1,79 @@
+"""
+Semantic Cache
+Reuses LLM results for paraphrased queries by comparing query embeddings
+"""
+import threading
+from typing import Any, Dict, Hashable, List, Optional
+
+import numpy as np
+
+
+class SemanticCache:
+    """
+    Bounded (embedding -> result) store with cosine-similarity lookup
+
+    Embeddings are L2-normalized on insert, so a lookup is a single
+    matrix-vector product. Entries are scoped (e.g. by user preferences) and
+    only match queries in the same scope. When full, the least recently used
+    entry is replaced.
+    """
+
+    def __init__(self, maxsize: int = 2048, threshold: float = 0.92):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        # Allocated on the first insert, once the embedding size is known
+        self._embeddings: Optional[np.ndarray] = None
+        self._scopes = np.full(maxsize, -1, dtype=np.int64)
+        self._last_used = np.zeros(maxsize, dtype=np.int64)
+        self._results: List[Optional[Dict[str, Any]]] = [None] * maxsize
+        self._scope_ids: Dict[Hashable, int] = {}
+        self._size = 0
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, embedding, scope: Hashable) -> Optional[Dict[str, Any]]:
+        """Return the stored result most similar to the embedding, if above the threshold"""
+        query = self._normalize(embedding)
+        with self._lock:
+            scope_id = self._scope_ids.get(scope)
+            if scope_id is None or self._size == 0:
+                return None
+
+            similarities = self._embeddings[:self._size] @ query
+            similarities[self._scopes[:self._size] != scope_id] = -1.0
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+
+            self._tick += 1
+            self._last_used[best] = self._tick
+            return self._results[best]
+
+    def add(self, embedding, scope: Hashable, result: Dict[str, Any]) -> None:
+        """Store a result, evicting the least recently used entry when full"""
+        vector = self._normalize(embedding)
+        with self._lock:
+            if self._embeddings is None:
+                self._embeddings = np.zeros((self.maxsize, vector.shape[0]), dtype=np.float32)
+
+            if self._size < self.maxsize:
+                index = self._size
+                self._size += 1
+            else:
+                index = int(np.argmin(self._last_used))
+
+            scope_id = self._scope_ids.setdefault(scope, len(self._scope_ids))
+            self._tick += 1
+            self._embeddings[index] = vector
+            self._scopes[index] = scope_id
+            self._last_used[index] = self._tick
+            self._results[index] = result
+
+    def __len__(self) -> int:
+        return self._size
@@ -3,11 +3,71 @@ Yelp API Service for Restaurant Search
 Integrates with Yelp Fusion API to search for restaurants
 """
 import os
+import asyncio
+import httpx
 import requests
+from dataclasses import dataclass
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from functools import lru_cache
 from typing import Dict, List, Any, Optional
 from loguru import logger
 
 
+_METERS_TO_MILES = 0.000621371
+
+# Business detail lookups allowed in flight at once in get_business_details_many
+YELP_DETAILS_MAX_CONCURRENCY = 8
+
+# Retry policy for transient errors and rate limits (sync and async clients)
+YELP_MAX_RETRIES = 2
+YELP_RETRY_BACKOFF_SECONDS = 0.2
+# Longest Retry-After wait honoured inside a request; longer ones give up instead
+YELP_RETRY_AFTER_MAX_SECONDS = 2
+_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Saved price_range preference -> Yelp price level (shared with the LLM
+# service). The survey stores the named values; the symbols are accepted too
+PRICE_LEVELS = {
+    "budget": 1,
+    "moderate": 2,
+    "upscale": 3,
+    "fine-dining": 4,
+    "$": 1,
+    "$$": 2,
+    "$$$": 3,
+    "$$$$": 4
+}
+
+# LLM special features (lower-case) -> Yelp attributes
+_FEATURE_MAP = {
+    "reservations": "reservation",
+    "outdoor seating": "outdoor_seating",
+    "takeout": "restaurant_takeout",
+    "delivery": "restaurant_delivery",
+    "wheelchair accessible": "wheelchair_accessible",
+    "good for groups": "good_for_groups",
+    "hot and new": "hot_and_new"
+}
+
+
+@dataclass(slots=True, frozen=True)
+class Restaurant:
+    """A Yelp business formatted for display"""
+    id: Optional[str]
+    name: Optional[str]
+    rating: Optional[float]
+    review_count: Optional[int]
+    price: Optional[str]
+    categories: List[str]
+    address: str
+    phone: Optional[str]
+    image_url: Optional[str]
+    url: Optional[str]
+    distance: float  # miles
+    is_closed: bool
+
+
 class YelpService:
     """Service for searching restaurants using Yelp Fusion API"""
 
@@ -18,11 +78,65 @@ class YelpService:
             raise ValueError("YELP_API_KEY environment variable is not set")
 
         self.base_url = "https://api.yelp.com/v3"
+        self._search_url = f"{self.base_url}/businesses/search"
+        self._detail_url_prefix = f"{self.base_url}/businesses/"
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Accept": "application/json"
         }
 
+        # Keep-alive connection pool so requests reuse TCP/TLS connections to Yelp;
+        # transient errors and rate limits are retried with a short backoff
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=20,
+            max_retries=Retry(
+                total=YELP_MAX_RETRIES,
+                backoff_factor=YELP_RETRY_BACKOFF_SECONDS,
+                status_forcelist=_RETRY_STATUSES,
+                raise_on_status=False
+            )
+        )
+        self.session.mount("https://", adapter)
+
+        # Async client for the event loop; HTTP/2 multiplexes concurrent
+        # requests (e.g. a batch of business lookups) over one connection
+        self.aclient = httpx.AsyncClient(
+            http2=True,
+            headers=self.headers,
+            timeout=10.0,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=20)
+        )
+
+    async def _aget(self, url: str, params: Optional[Dict[str, Any]] = None) -> httpx.Response:
+        """GET with the async client, retrying like the sync session does"""
+        for attempt in range(YELP_MAX_RETRIES + 1):
+            last_attempt = attempt == YELP_MAX_RETRIES
+            try:
+                response = await self.aclient.get(url, params=params)
+            except httpx.TransportError:
+                if last_attempt:
+                    raise
+            else:
+                if response.status_code not in _RETRY_STATUSES or last_attempt:
+                    return response
+                # Rate limits may say how long to wait; the caller is waiting
+                # on this request, so return the error rather than wait long
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    if int(retry_after) > YELP_RETRY_AFTER_MAX_SECONDS:
+                        return response
+                    await asyncio.sleep(int(retry_after))
+                    continue
+            await asyncio.sleep(YELP_RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
+    async def aclose(self) -> None:
+        """Close the pooled connections"""
+        await self.aclient.aclose()
+        self.session.close()
+
     def search_restaurants(
         self,
         location: str,
@@ -50,9 +164,80 @@ class YelpService:
         Returns:
             Dict with 'businesses' list and 'total' count
         """
-        endpoint = f"{self.base_url}/businesses/search"
+        endpoint = self._search_url
+        params = self._search_params(location, categories, price, term, attributes, limit, offset, sort_by)
+
+        logger.debug("🌐 Yelp API Request: {} params={}", endpoint, params)
+
+        try:
+            response = self.session.get(endpoint, params=params, timeout=10)
+            response.raise_for_status()
+            result = response.json()
+            logger.info(
+                "✅ Yelp API returned {} total results, {} businesses in response",
+                result.get('total', 0), len(result.get('businesses', []))
+            )
+            return result
+
+        except requests.exceptions.HTTPError as e:
+            return self._search_error(e.response, e)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"❌ Yelp API request failed: {str(e)}")
+            return {
+                "error": f"Request failed: {str(e)}",
+                "businesses": [],
+                "total": 0
+            }
+
+    async def search_restaurants_async(
+        self,
+        location: str,
+        categories: Optional[List[str]] = None,
+        price: Optional[List[int]] = None,
+        term: Optional[str] = None,
+        attributes: Optional[List[str]] = None,
+        limit: int = 10,
+        offset: int = 0,
+        sort_by: str = "best_match"
+    ) -> Dict[str, Any]:
+        """Async version of search_restaurants (same arguments and result)"""
+        endpoint = self._search_url
+        params = self._search_params(location, categories, price, term, attributes, limit, offset, sort_by)
 
-        # Build query parameters
+        logger.debug("🌐 Yelp API Request: {} params={}", endpoint, params)
+
+        try:
+            response = await self._aget(endpoint, params=params)
+            response.raise_for_status()
+            result = response.json()
+            logger.info(
+                "✅ Yelp API returned {} total results, {} businesses in response",
+                result.get('total', 0), len(result.get('businesses', []))
+            )
+            return result
+
+        except httpx.HTTPStatusError as e:
+            return self._search_error(e.response, e)
+        except httpx.HTTPError as e:
+            logger.error(f"❌ Yelp API request failed: {str(e)}")
+            return {
+                "error": f"Request failed: {str(e)}",
+                "businesses": [],
+                "total": 0
+            }
+
+    @staticmethod
+    def _search_params(
+        location: str,
+        categories: Optional[List[str]],
+        price: Optional[List[int]],
+        term: Optional[str],
+        attributes: Optional[List[str]],
+        limit: int,
+        offset: int,
+        sort_by: str
+    ) -> Dict[str, Any]:
+        """Build the query parameters for a business search"""
         params = {
             "location": location,
             "limit": min(limit, 50),  # Yelp max is 50
@@ -74,44 +259,31 @@ class YelpService:
         if attributes:
             params["attributes"] = ",".join(attributes)
 
-        logger.info(f"🌐 Yelp API Request: {endpoint}")
-        logger.info(f"🌐 Params: {params}")
-
-        try:
-            response = requests.get(endpoint, headers=self.headers, params=params, timeout=10)
-            response.raise_for_status()
-            result = response.json()
-            logger.info(f"✅ Yelp API returned {result.get('total', 0)} total results, {len(result.get('businesses', []))} businesses in response")
-            return result
+        return params
 
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 400:
-                error_details = e.response.json()
-                logger.error(f"❌ Yelp API 400 Bad Request: {error_details}")
-                return {
-                    "error": "Invalid request parameters",
-                    "details": error_details,
-                    "businesses": [],
-                    "total": 0
-                }
-            elif e.response.status_code == 401:
-                logger.error("❌ Yelp API 401 Unauthorized - Invalid API key")
-                return {
-                    "error": "Invalid Yelp API key",
-                    "businesses": [],
-                    "total": 0
-                }
-            else:
-                logger.error(f"❌ Yelp API error {e.response.status_code}: {e}")
-                return {
-                    "error": f"Yelp API error: {e.response.status_code}",
-                    "businesses": [],
-                    "total": 0
-                }
-        except requests.exceptions.RequestException as e:
-            logger.error(f"❌ Yelp API request failed: {str(e)}")
+    @staticmethod
+    def _search_error(response, error: Exception) -> Dict[str, Any]:
+        """Turn an error status from the search endpoint into an empty result"""
+        if response.status_code == 400:
+            error_details = response.json()
+            logger.error(f"❌ Yelp API 400 Bad Request: {error_details}")
             return {
-                "error": f"Request failed: {str(e)}",
+                "error": "Invalid request parameters",
+                "details": error_details,
+                "businesses": [],
+                "total": 0
+            }
+        elif response.status_code == 401:
+            logger.error("❌ Yelp API 401 Unauthorized - Invalid API key")
+            return {
+                "error": "Invalid Yelp API key",
+                "businesses": [],
+                "total": 0
+            }
+        else:
+            logger.error(f"❌ Yelp API error {response.status_code}: {error}")
+            return {
+                "error": f"Yelp API error: {response.status_code}",
                 "businesses": [],
                 "total": 0
             }
@@ -126,16 +298,60 @@ class YelpService:
         Returns:
             Dict with business details or None if error
         """
-        endpoint = f"{self.base_url}/businesses/{business_id}"
+        endpoint = self._detail_url_prefix + business_id
 
         try:
-            response = requests.get(endpoint, headers=self.headers, timeout=10)
+            response = self.session.get(endpoint, timeout=10)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
-            print(f"Error fetching business details: {e}")
+            logger.error(f"❌ Error fetching business details for {business_id}: {e}")
             return None
 
+    async def get_business_details_async(self, business_id: str) -> Optional[Dict[str, Any]]:
+        """Async version of get_business_details"""
+        endpoint = self._detail_url_prefix + business_id
+
+        try:
+            response = await self._aget(endpoint)
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPError as e:
+            logger.error(f"❌ Error fetching business details for {business_id}: {e}")
+            return None
+
+    async def get_business_details_many(
+        self,
+        business_ids: List[str],
+        max_concurrency: int = YELP_DETAILS_MAX_CONCURRENCY
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Fetch details for several businesses concurrently
+
+        The requests are multiplexed over one HTTP/2 connection, so the batch
+        takes about as long as the slowest single lookup. At most
+        max_concurrency are in flight at once to stay under Yelp's rate limit.
+
+        Returns:
+            Details in the same order as business_ids (None for failed lookups)
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def fetch(business_id: str) -> Optional[Dict[str, Any]]:
+            async with semaphore:
+                return await self.get_business_details_async(business_id)
+
+        results = await asyncio.gather(*(fetch(business_id) for business_id in business_ids), return_exceptions=True)
+
+        # One bad lookup should not fail the whole batch
+        details = []
+        for business_id, result in zip(business_ids, results):
+            if isinstance(result, Exception):
+                logger.error(f"❌ Error fetching business details for {business_id}: {result}")
+                result = None
+            details.append(result)
+        return details
+
     def search_with_llm_params(
         self,
         location: str,
@@ -155,11 +371,30 @@ class YelpService:
         Returns:
             Yelp search results
         """
+        return self.search_restaurants(**self._llm_search_kwargs(location, llm_categories, user_preferences, limit))
+
+    async def search_with_llm_params_async(
+        self,
+        location: str,
+        llm_categories: Dict[str, Any],
+        user_preferences: Optional[Dict[str, Any]] = None,
+        limit: int = 10
+    ) -> Dict[str, Any]:
+        """Async version of search_with_llm_params"""
+        return await self.search_restaurants_async(**self._llm_search_kwargs(location, llm_categories, user_preferences, limit))
+
+    def _llm_search_kwargs(
+        self,
+        location: str,
+        llm_categories: Dict[str, Any],
+        user_preferences: Optional[Dict[str, Any]],
+        limit: int
+    ) -> Dict[str, Any]:
+        """Map LLM output (and saved preferences) to search_restaurants arguments"""
         # Extract attributes from LLM output
         attributes = llm_categories.get("attributes", {})
         primary_categories = llm_categories.get("primary_categories", [])
-        logger.info(f"🔍 Parsing LLM params - attributes: {attributes}")
-        logger.info(f"🔍 Primary categories: {primary_categories}")
+        logger.debug("🔍 Parsing LLM params - attributes: {} primary categories: {}", attributes, primary_categories)
 
         # Determine price level
         price = None
@@ -174,8 +409,7 @@ class YelpService:
 
         if not price and user_preferences and user_preferences.get("price_range"):
             # Convert price_range from user preferences
-            price_map = {"$": [1], "$$": [2], "$$$": [3], "$$$$": [4]}
-            price = price_map.get(user_preferences["price_range"], [2])
+            price = [PRICE_LEVELS.get(user_preferences["price_range"], 2)]
 
         # Build search term from cuisine and keywords
         term_parts = []
@@ -189,44 +423,75 @@ class YelpService:
 
         term = " ".join(term_parts) if term_parts else None
 
-        logger.info(f"🔍 Extracted price: {price}")
-        logger.info(f"🔍 Extracted search term: {term}")
+        logger.debug("🔍 Extracted price: {} search term: {}", price, term)
 
-        # Build Yelp attributes list
-        yelp_attributes = []
+        # Map special features to Yelp attributes
         special_features = attributes.get("special_features", [])
+        yelp_attributes = [
+            yelp_attribute
+            for feature in special_features
+            if (yelp_attribute := _FEATURE_MAP.get(feature.lower())) is not None
+        ]
 
-        # Map special features to Yelp attributes
-        feature_map = {
-            "reservations": "reservation",
-            "outdoor seating": "outdoor_seating",
-            "takeout": "restaurant_takeout",
-            "delivery": "restaurant_delivery",
-            "wheelchair accessible": "wheelchair_accessible",
-            "good for groups": "good_for_groups",
-            "hot and new": "hot_and_new"
+        logger.debug("🔍 Yelp attributes: {}", yelp_attributes)
+
+        return {
+            "location": location,
+            "categories": primary_categories if primary_categories else None,
+            "price": price,
+            "term": term,
+            "attributes": yelp_attributes if yelp_attributes else None,
+            "limit": limit,
+            "sort_by": "best_match"
         }
 
-        for feature in special_features:
-            feature_lower = feature.lower()
-            if feature_lower in feature_map:
-                yelp_attributes.append(feature_map[feature_lower])
-
-        logger.info(f"🔍 Yelp attributes: {yelp_attributes}")
-        logger.info(f"📞 Calling Yelp API with: location={location}, categories={primary_categories}, price={price}, term={term}")
-
-        # Perform search
-        return self.search_restaurants(
-            location=location,
-            categories=primary_categories if primary_categories else None,
-            price=price,
-            term=term,
-            attributes=yelp_attributes if yelp_attributes else None,
-            limit=limit,
-            sort_by="best_match"
-        )
+    def search_with_preferences(
+        self,
+        location: str,
+        user_preferences: Dict[str, Any],
+        limit: int = 10
+    ) -> Dict[str, Any]:
+        """
+        Search for restaurants using only the user's saved preferences
+        Cheap enough to run speculatively while the LLM is still generating categories
 
-    def format_restaurant_for_display(self, business: Dict[str, Any]) -> Dict[str, Any]:
+        Args:
+            location: City or address to search in
+            user_preferences: User's saved preferences (cuisine_type, price_range, ...)
+            limit: Number of results to return
+
+        Returns:
+            Yelp search results
+        """
+        return self.search_restaurants(**self._preference_search_kwargs(location, user_preferences, limit))
+
+    async def search_with_preferences_async(
+        self,
+        location: str,
+        user_preferences: Dict[str, Any],
+        limit: int = 10
+    ) -> Dict[str, Any]:
+        """Async version of search_with_preferences"""
+        return await self.search_restaurants_async(**self._preference_search_kwargs(location, user_preferences, limit))
+
+    @staticmethod
+    def _preference_search_kwargs(
+        location: str,
+        user_preferences: Dict[str, Any],
+        limit: int
+    ) -> Dict[str, Any]:
+        """Map saved preferences to search_restaurants arguments"""
+        price_level = PRICE_LEVELS.get(user_preferences.get("price_range"))
+        return {
+            "location": location,
+            "categories": ["restaurants"],
+            "price": [price_level] if price_level else None,
+            "term": user_preferences.get("cuisine_type"),
+            "limit": limit,
+            "sort_by": "best_match"
+        }
+
+    def format_restaurant_for_display(self, business: Dict[str, Any]) -> Restaurant:
         """
         Format a Yelp business result for user-friendly display
 
@@ -236,29 +501,42 @@ class YelpService:
         Returns:
             Formatted restaurant info
         """
-        return {
-            "id": business.get("id"),
-            "name": business.get("name"),
-            "rating": business.get("rating"),
-            "review_count": business.get("review_count"),
-            "price": business.get("price", "N/A"),
-            "categories": [cat["title"] for cat in business.get("categories", [])],
-            "address": " ".join(business.get("location", {}).get("display_address", [])),
-            "phone": business.get("display_phone", "N/A"),
-            "image_url": business.get("image_url"),
-            "url": business.get("url"),
-            "distance": round(business.get("distance", 0) * 0.000621371, 2),  # Convert meters to miles
-            "is_closed": business.get("is_closed", False)
-        }
+        return Restaurant(
+            id=business.get("id"),
+            name=business.get("name"),
+            rating=business.get("rating"),
+            review_count=business.get("review_count"),
+            price=business.get("price", "N/A"),
+            categories=[cat["title"] for cat in business.get("categories", ())],
+            address=" ".join(business.get("location", {}).get("display_address", ())),
+            phone=business.get("display_phone", "N/A"),
+            image_url=business.get("image_url"),
+            url=business.get("url"),
+            distance=round(business.get("distance", 0) * _METERS_TO_MILES, 2),  # Convert meters to miles
+            is_closed=business.get("is_closed", False)
+        )
+
+    def format_many(self, businesses: List[Dict[str, Any]]) -> List[Restaurant]:
+        """
+        Format a list of Yelp business results for display
 
+        Args:
+            businesses: Raw business objects from a Yelp search
 
-# Singleton instance
-_yelp_service_instance = None
+        Returns:
+            Formatted restaurant info, in the same order
+        """
+        format_restaurant = self.format_restaurant_for_display
+        return [format_restaurant(business) for business in businesses]
 
 
+@lru_cache(maxsize=1)
 def get_yelp_service() -> YelpService:
     """Get or create the Yelp service singleton"""
-    global _yelp_service_instance
-    if _yelp_service_instance is None:
-        _yelp_service_instance = YelpService()
-    return _yelp_service_instance
+    return YelpService()
+
+
+async def close_yelp_service() -> None:
+    """Close the Yelp service's connections, if it was ever created"""
+    if get_yelp_service.cache_info().currsize:
+        await get_yelp_service().aclose()
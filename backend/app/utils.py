@@ -1,7 +1,12 @@
+import asyncio
 import bcrypt
+import hashlib
 import jwt
 import os
-from datetime import datetime, timedelta
+import re
+import threading
+import time
+from cachetools import TLRUCache
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -9,10 +14,26 @@ load_dotenv()
 JWT_SECRET = os.getenv('JWT_SECRET', 'your-secret-key')
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRATION_HOURS = 24
+_JWT_EXPIRATION_SECONDS = JWT_EXPIRATION_HOURS * 60 * 60
+_JWT_SECRET_BYTES = JWT_SECRET.encode('utf-8')
+JWT_CACHE_TTL_SECONDS = 60
+# bcrypt work factor; each +1 doubles hashing time (calibrate on the deployment host)
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+# "<scheme> <token>", allowing the same surrounding and separating whitespace as str.split()
+_AUTHORIZATION_RE = re.compile(r'\s*(\S+)\s+(\S+)\s*')
+
+def _token_ttu(_key, payload: dict, now: float) -> float:
+    """Keep a verified token for the cache TTL, but never past its own expiry"""
+    return min(payload['exp'], now + JWT_CACHE_TTL_SECONDS)
+
+# Payloads of recently verified tokens, keyed by the SHA-256 digest of the token
+# (wall-clock timer, since 'exp' is a Unix timestamp)
+_token_cache = TLRUCache(maxsize=10000, ttu=_token_ttu, timer=time.time)
+_token_cache_lock = threading.Lock()
 
 def hash_password(password: str) -> str:
     """Hash a password using bcrypt"""
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
     return hashed.decode('utf-8')
 
@@ -20,41 +41,64 @@ def verify_password(password: str, hashed_password: str) -> bool:
     """Verify a password against a hash"""
     return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
 
+async def hash_password_async(password: str) -> str:
+    """Hash a password in a worker thread (bcrypt is CPU-bound and would block the event loop)"""
+    return await asyncio.to_thread(hash_password, password)
+
+async def verify_password_async(password: str, hashed_password: str) -> bool:
+    """Verify a password in a worker thread"""
+    return await asyncio.to_thread(verify_password, password, hashed_password)
+
 def create_access_token(user_id: int, username: str) -> str:
     """Create a JWT access token"""
-    expiration = datetime.utcnow() + timedelta(hours=JWT_EXPIRATION_HOURS)
     payload = {
         'user_id': user_id,
         'username': username,
-        'exp': expiration
+        # Unix timestamp, which is what PyJWT would convert a datetime to anyway
+        'exp': int(time.time()) + _JWT_EXPIRATION_SECONDS
     }
-    token = jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    token = jwt.encode(payload, _JWT_SECRET_BYTES, algorithm=JWT_ALGORITHM)
     return token
 
 def decode_access_token(token: str) -> dict:
     """Decode and verify a JWT token"""
-    try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    # Skip signature verification for tokens verified within the cache TTL
+    cache_key = hashlib.sha256(token.encode('utf-8')).digest()
+    with _token_cache_lock:
+        payload = _token_cache.get(cache_key)
+    if payload is not None:
         return payload
+
+    try:
+        payload = jwt.decode(token, _JWT_SECRET_BYTES, algorithms=[JWT_ALGORITHM])
     except jwt.ExpiredSignatureError:
         raise Exception("Token has expired")
     except jwt.InvalidTokenError:
         raise Exception("Invalid token")
 
+    with _token_cache_lock:
+        _token_cache[cache_key] = payload
+    return payload
+
+def get_bearer_token(authorization: str) -> str:
+    """Return the token from a "Bearer <token>" Authorization header"""
+    match = _AUTHORIZATION_RE.fullmatch(authorization)
+    if not match:
+        raise Exception("Invalid authorization header format")
+
+    scheme, token = match.groups()
+    if scheme.lower() != 'bearer':
+        raise Exception("Invalid authentication scheme")
+    return token
+
 def get_current_user(authorization: str = None) -> int:
     """Extract user ID from Authorization header"""
     if not authorization:
         raise Exception("Missing authorization header")
 
-    # Authorization header format: "Bearer <token>"
     try:
-        scheme, token = authorization.split()
-        if scheme.lower() != 'bearer':
-            raise Exception("Invalid authentication scheme")
-
+        token = get_bearer_token(authorization)
         payload = decode_access_token(token)
         return payload['user_id']
-    except ValueError:
-        raise Exception("Invalid authorization header format")
     except Exception as e:
         raise Exception(f"Authentication failed: {str(e)}")
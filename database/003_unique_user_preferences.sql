@@ -0,0 +1,26 @@
+-- Migration: Allow at most one preferences row per user
+-- Required by the INSERT ... ON CONFLICT (user_id) upsert in the preferences API
+
+-- Keep only the most recent preferences row for each user
+DELETE FROM user_preferences a
+USING user_preferences b
+WHERE a.user_id = b.user_id
+  AND a.id < b.id;
+
+-- Add the unique constraint (same name as the inline constraint in init.sql),
+-- unless the database was created from an init.sql that already has it
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint
+        WHERE conrelid = 'user_preferences'::regclass
+          AND conname = 'user_preferences_user_id_key'
+    ) THEN
+        ALTER TABLE user_preferences
+            ADD CONSTRAINT user_preferences_user_id_key UNIQUE (user_id);
+    END IF;
+END
+$$;
+
+-- The constraint's index makes the plain user_id index redundant
+DROP INDEX IF EXISTS idx_user_preferences_user_id;
@@ -0,0 +1,43 @@
+-- Migration: Index chat session listing and keep a per-session message counter
+
+-- Sessions are listed per user, most recent first
+CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_last_message
+    ON chat_sessions(user_id, last_message_at DESC);
+
+-- Covered by the index above
+DROP INDEX IF EXISTS idx_chat_sessions_user_id;
+
+-- Messages are read per session in insertion order
+CREATE INDEX IF NOT EXISTS idx_chat_messages_session_created
+    ON chat_messages(session_id, created_at, id);
+
+-- Covered by the index above
+DROP INDEX IF EXISTS idx_chat_messages_session_id;
+
+-- Store the message count on the session instead of counting on every listing
+ALTER TABLE chat_sessions ADD COLUMN IF NOT EXISTS message_count INTEGER NOT NULL DEFAULT 0;
+
+-- Backfill counts for existing sessions
+UPDATE chat_sessions cs
+SET message_count = counts.message_count
+FROM (
+    SELECT session_id, COUNT(*) AS message_count
+    FROM chat_messages
+    GROUP BY session_id
+) counts
+WHERE counts.session_id = cs.id;
+
+-- Messages are only ever inserted (they are removed with their session),
+-- so the existing insert trigger can maintain the counter
+CREATE OR REPLACE FUNCTION update_session_last_message()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE chat_sessions
+    SET last_message_at = CURRENT_TIMESTAMP,
+        message_count = message_count + 1
+    WHERE id = NEW.session_id;
+    RETURN NEW;
+END;
+$$ language 'plpgsql';
+
+COMMENT ON COLUMN chat_sessions.message_count IS 'Number of messages in the session, maintained by update_session_timestamp trigger';